@@ -33,7 +33,7 @@ try:
         from internalblue.hci import HCI
         from internalblue.core import InternalBlue
 
-        Record = Tuple[HCI, int, int, int, Any, datetime.datetime]
+        Record = Tuple[HCI, int, int, int, Any, Optional[datetime.datetime]]
         FilterFunction = Callable[[Record], bool]
 
         Opcode = NewType("Opcode", int)
@@ -338,25 +338,7 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
 
             elif self.__class__.__name__ == "HCICore":
                 if self.write_btsnooplog:
-                    # btsnoop record header data:
-                    btsnoop_data = p8(h4type) + data
-                    btsnoop_orig_len = len(btsnoop_data)
-                    btsnoop_inc_len = len(btsnoop_data)
-                    btsnoop_flags = 0
-                    btsnoop_drops = 0
-                    btsnoop_time = datetime.datetime.now()
-                    btsnoop_record_hdr = struct.pack(
-                        ">IIIIq",
-                        btsnoop_orig_len,
-                        btsnoop_inc_len,
-                        btsnoop_flags,
-                        btsnoop_drops,
-                        self._btsnoop_pack_time(btsnoop_time),
-                    )
-                    with self.btsnooplog_file_lock:
-                        self.btsnooplog_file.write(btsnoop_record_hdr)
-                        self.btsnooplog_file.write(btsnoop_data)
-                        self.btsnooplog_file.flush()
+                    self._writeBTSnoopRecord(p8(h4type) + data)
 
                 # Prepend UART TYPE and length.
                 out = p8(h4type) + data
@@ -795,7 +777,8 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         - inc_len
         - flags
         - drops
-        - timestamp (python datetime object)
+        - timestamp (python datetime object, may be None if the core
+          does not record timestamps, e.g. HCICore without btsnoop log)
         """
 
         if callback in self.registeredHciCallbacks:
@@ -825,7 +808,8 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         - inc_len
         - flags
         - drops
-        - timestamp (python datetime object)
+        - timestamp (python datetime object, may be None if the core
+          does not record timestamps, e.g. HCICore without btsnoop log)
 
         If filter_function is not None, the tuple will first be passed
         to the function and only if the function returns True, the packet
@@ -4,28 +4,25 @@ from __future__ import absolute_import
 
 import datetime
 import fcntl
+import functools
+import os
 import queue as queue2k
 import socket
 import struct
 import threading
-from builtins import range
-from builtins import str
-from builtins import zip
+import time
+from collections import deque
 
 from ctypes import *
 
-from typing import List, cast, TYPE_CHECKING
-
-from future import standard_library
+from typing import Deque, List, Optional, Tuple, cast, TYPE_CHECKING
 
 from . import hci
 from .core import InternalBlue
-from .utils.packing import p16, u16, p32, u32
+from .utils.packing import p32
 
 if TYPE_CHECKING:
-    from internalblue import Device
-
-standard_library.install_aliases()
+    from internalblue import Device, FilterFunction, Record
 
 
 class sockaddr_hci(Structure):
@@ -53,6 +50,101 @@ HCIDEVUP = _IOW(ord("H"), 201, 4)
 HCIGETDEVLIST = _IOR(ord("H"), 210, 4)
 HCIGETDEVINFO = _IOR(ord("H"), 211, 4)
 
+HCI_CHANNEL_USER = 1
+
+# libc socket() and bind() with argtypes set, see _getLibc()
+_libc = None
+
+
+def _getLibc():
+    """
+    Load libc once and prepare socket() and bind() for setting up an HCI User
+    Channel via ctypes. This is done on first use, not on import, because libc.so.6
+    only exists on Linux.
+    """
+    global _libc
+    if _libc is None:
+        libc = CDLL("libc.so.6")
+
+        libc.socket.argtypes = (c_int, c_int, c_int)
+        libc.socket.restype = c_int
+
+        libc.bind.argtypes = (c_int, POINTER(sockaddr_hci), c_int)
+        libc.bind.restype = c_int
+
+        _libc = libc
+    return _libc
+
+
+# Largest H4 packet the HCI socket can return in one read: H4 type, ACL header
+# (handle + 16 bit length) and up to 0xFFFF bytes of ACL payload. HCI sockets
+# deliver one complete packet per read, so a receive buffer of this size never
+# truncates a packet.
+_H4_MAX_PACKET_SIZE = 1 + 4 + 0xFFFF
+
+# Precompiled struct formats for the per-packet btsnoop record header
+# (orig_len, inc_len, flags, drops, timestamp) and the ioctl result fields.
+_BTSNOOP_HDR = struct.Struct(">IIIIq")
+_U16LE = struct.Struct("<H")
+_U32LE = struct.Struct("<I")
+
+# btsnoop record time is a 64-bit signed integer representing the time of packet arrival,
+# in microseconds since midnight, January 1st, 0 AD nominal Gregorian. Midnight,
+# January 1st 2000 AD is represented as 0x00E03AB44A676000 (see RFC 1761 and
+# https://github.com/joekickass/python-btsnoop). This is the offset to add to a
+# unix timestamp in microseconds.
+_BTSNOOP_EPOCH_US = 0x00E03AB44A676000 - 946684800 * 1000000
+
+
+def _packBTSnoopRecordHeader(length, timestamp):
+    # type: (int, float) -> bytes
+    """
+    Pack the btsnoop record header for an H4 packet of the given length that
+    was captured at timestamp (unix time in seconds, UTC).
+    """
+    return _BTSNOOP_HDR.pack(
+        length,  # orig_len
+        length,  # inc_len
+        0,  # flags
+        0,  # drops
+        int(timestamp * 1000000) + _BTSNOOP_EPOCH_US,
+    )
+
+
+# Reusable HCIGETDEVLIST argument (struct hci_dev_list_req with HCI_MAX_DEV = 16
+# entries), filled in place by the kernel.
+_DEVLIST_BUF = bytearray(4 + 8 * 16)
+
+# Reusable HCIGETDEVINFO argument, filled in place by the kernel.
+# Enough space for dev_id, name, bdaddr and flags of struct hci_dev_info.
+_DEV_INFO_BUF = bytearray(22)
+
+# Names of the hci_dev_info flag bits, indexed by bit number (HCI_UP = 0, ...)
+_HCI_FLAG_NAMES = (
+    "UP",
+    "INIT",
+    "RUNNING",
+    "PSCAN",
+    "ISCAN",
+    "AUTH",
+    "ENCRYPT",
+    "INQUIRY",
+    "RAW",
+    "RESET",
+)
+
+
+@functools.lru_cache(maxsize=64)
+def _decodeHciFlags(dev_flags):
+    # type: (int) -> str
+    """
+    Convert hci_dev_info flags to a string (e.g. "UP RUNNING" or "DOWN").
+    Adapters only report a few distinct flag values, so results are cached.
+    """
+    return " ".join(
+        name for bit, name in enumerate(_HCI_FLAG_NAMES) if dev_flags & (1 << bit)
+    ) or "DOWN"
+
 
 class HCICore(InternalBlue):
     def __init__(
@@ -72,10 +164,80 @@ class HCICore(InternalBlue):
             replay,
         )
         self.btsnooplog_file_lock = threading.Lock()
+        # btsnoop records are appended with os.write() on the raw file descriptor.
+        # With O_APPEND a record that is written in one write() call is appended
+        # atomically at the end of the file, so the recv and send threads do not
+        # need btsnooplog_file_lock for them.
+        if self.write_btsnooplog:
+            self._btsnoop_fd = self.btsnooplog_file.fileno()
+            fcntl.fcntl(
+                self._btsnoop_fd,
+                fcntl.F_SETFL,
+                fcntl.fcntl(self._btsnoop_fd, fcntl.F_GETFL) | os.O_APPEND,
+            )
         self.serial = False
         self.doublecheck = False
         self.user_channel = user_channel
 
+        # The registeredHciRecvDeques list holds tuples (deque, event, filter_function).
+        # Like registeredHciRecvQueues, but the recvThread appends matching records to a
+        # bounded deque (dropping the oldest record if it is full) and sets the event.
+        # Use registerHciRecvDeque() and unregisterHciRecvDeque() to manage them.
+        self.registeredHciRecvDeques = (
+            []
+        )  # type: List[Tuple[Deque[Record], threading.Event, Optional[FilterFunction]]]
+        self.recv_deque_size = queue_size
+
+        # Bluetooth socket used to execute ioctl's, see _getIoctlSocket()
+        self._ioctl_sock = None  # type: Optional[socket.socket]
+
+        # Persistent receive buffer for s_snoop, filled with recv_into()
+        self._recv_buf = bytearray(_H4_MAX_PACKET_SIZE)
+        self._recv_mv = memoryview(self._recv_buf)
+
+    def registerHciRecvDeque(self, filter_function=None, maxlen=None):
+        # type: (Optional[FilterFunction], Optional[int]) -> Tuple[Deque[Record], threading.Event]
+        """
+        Lightweight alternative to registerHciRecvQueue() for a single consumer.
+        Returns a tuple (recv_deque, event). Every time the recvThread receives a
+        HCI packet that matches filter_function (or any packet if filter_function
+        is None), the record tuple is appended to recv_deque and event is set.
+        The consumer should clear the event before popping records with popleft().
+        If the deque holds maxlen records (default: queue_size of the core), the
+        oldest record is dropped.
+        """
+
+        if maxlen is None:
+            maxlen = self.recv_deque_size
+        recv_deque = deque(maxlen=maxlen)  # type: Deque[Record]
+        event = threading.Event()
+        self.registeredHciRecvDeques.append((recv_deque, event, filter_function))
+        return recv_deque, event
+
+    def unregisterHciRecvDeque(self, recv_deque):
+        # type: (Deque[Record]) -> None
+        """
+        Remove a deque returned by registerHciRecvDeque() from self.registeredHciRecvDeques.
+        """
+
+        for entry in self.registeredHciRecvDeques:
+            if entry[0] is recv_deque:
+                self.registeredHciRecvDeques.remove(entry)
+                return
+        self.logger.warning("unregisterHciRecvDeque: no such deque is registered!")
+
+    def _getIoctlSocket(self):
+        # type: () -> socket.socket
+        """
+        Return the Bluetooth socket used to execute ioctl's. It is opened on
+        first use (or if it was closed) and kept open until _teardownSockets().
+        """
+        if self._ioctl_sock is None or self._ioctl_sock.fileno() == -1:
+            self._ioctl_sock = socket.socket(
+                socket.AF_BLUETOOTH, socket.SOCK_RAW, socket.BTPROTO_HCI
+            )
+        return self._ioctl_sock
+
     def getHciDeviceList(self):
         # type: () -> List[Device]
         """
@@ -89,9 +251,9 @@ class HCICore(InternalBlue):
             dev_flags_str   : Device flags as String (e.g. "UP RUNNING" or "DOWN")
         """
 
-        # Open Bluetooth socket to execute ioctl's:
+        # Get Bluetooth socket to execute ioctl's:
         try:
-            s = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW, socket.BTPROTO_HCI)
+            s = self._getIoctlSocket()
         # Ticket 6: does not run on Windows with Kali subsystem
         except socket.error:
             self.logger.warn(
@@ -101,47 +263,22 @@ class HCICore(InternalBlue):
 
         # Do ioctl(s,HCIGETDEVLIST,arg) to get the number of available devices:
         # arg is struct hci_dev_list_req (/usr/include/bluetooth/hci.h)
-        arg = p32(16)  # dl->dev_num = HCI_MAX_DEV which is 16 (little endian)
-        arg += b"\x00" * (8 * 16)
-        devices_raw = fcntl.ioctl(s.fileno(), HCIGETDEVLIST, arg)
-        num_devices = u16(devices_raw[:2])
+        _U32LE.pack_into(_DEVLIST_BUF, 0, 16)  # dl->dev_num = HCI_MAX_DEV which is 16
+        fcntl.ioctl(s.fileno(), HCIGETDEVLIST, _DEVLIST_BUF, True)
+        num_devices = _U16LE.unpack_from(_DEVLIST_BUF, 0)[0]
         self.logger.debug("Found %d HCI devices via ioctl(HCIGETDEVLIST)!" % num_devices)
 
         device_list = []
         for dev_nr in range(num_devices):
             dev_struct_start = 4 + 8 * dev_nr
-            dev_id = u16(devices_raw[dev_struct_start: dev_struct_start + 2])
+            dev_id = _U16LE.unpack_from(_DEVLIST_BUF, dev_struct_start)[0]
             # arg is struct hci_dev_info (/usr/include/bluetooth/hci.h)
-            arg = p16(dev_id)  # di->dev_id = <device_id>
-            arg += b"\x00" * 20  # Enough space for name, bdaddr and flags
-            dev_info_raw = bytearray(fcntl.ioctl(s.fileno(), HCIGETDEVINFO, arg))
-            dev_name = dev_info_raw[2:10].replace(b"\x00", b"").decode()
-            dev_bdaddr = ":".join(["%02X" % x for x in dev_info_raw[10:16][::-1]])
-            dev_flags = u32(dev_info_raw[16:20])
-            if dev_flags == 0:
-                dev_flags_str = "DOWN"
-            else:
-                dev_flags_str = " ".join(
-                    [
-                        name
-                        for flag, name in zip(
-                            bin(dev_flags)[2:][::-1],
-                            [
-                                "UP",
-                                "INIT",
-                                "RUNNING",
-                                "PSCAN",
-                                "ISCAN",
-                                "AUTH",
-                                "ENCRYPT",
-                                "INQUIRY",
-                                "RAW",
-                                "RESET",
-                            ],
-                        )
-                        if flag == "1"
-                    ]
-                )
+            _U16LE.pack_into(_DEV_INFO_BUF, 0, dev_id)  # di->dev_id = <device_id>
+            fcntl.ioctl(s.fileno(), HCIGETDEVINFO, _DEV_INFO_BUF, True)
+            dev_name = _DEV_INFO_BUF[2:10].replace(b"\x00", b"").decode()
+            dev_bdaddr = "%02X:%02X:%02X:%02X:%02X:%02X" % tuple(_DEV_INFO_BUF[15:9:-1])
+            dev_flags = _U32LE.unpack_from(_DEV_INFO_BUF, 16)[0]
+            dev_flags_str = _decodeHciFlags(dev_flags)
 
             device_list.append(
                 {
@@ -152,7 +289,6 @@ class HCICore(InternalBlue):
                     "dev_flags_str": dev_flags_str,
                 }
             )
-        s.close()
         return cast("List[Device]", device_list)
 
     def bringHciDeviceUp(self, dev_id):
@@ -165,17 +301,15 @@ class HCICore(InternalBlue):
             self.logger.warn("bringHciDeviceUp: Invalid device id: %d." % dev_id)
             return False
 
-        # Open bluetooth socket to execute ioctl's:
-        s = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW, socket.BTPROTO_HCI)
+        # Get bluetooth socket to execute ioctl's:
+        s = self._getIoctlSocket()
 
         # Do ioctl(s, HCIDEVUP, dev_id) to bring device up:
         try:
             fcntl.ioctl(s.fileno(), HCIDEVUP, dev_id)
-            s.close()
             self.logger.info("Device with id=%d was set up successfully!" % dev_id)
             return True
         except IOError as e:
-            s.close()
             self.logger.warn("Error returned by ioctl: %s" % str(e))
             return False
 
@@ -229,43 +363,34 @@ class HCICore(InternalBlue):
 
         return True
 
-    def _btsnoop_pack_time(self, time):
-        """
-        Takes datetime object and returns microseconds since 2000-01-01.
-
-        see https://github.com/joekickass/python-btsnoop
-
-        Record time is a 64-bit signed integer representing the time of packet arrival,
-        in microseconds since midnight, January 1st, 0 AD nominal Gregorian.
-
-        In order to avoid leap-day ambiguity in calculations, note that an equivalent
-        epoch may be used of midnight, January 1st 2000 AD, which is represented in
-        this field as 0x00E03AB44A676000.
-        """
-        time_betw_0_and_2000_ad = int("0x00E03AB44A676000", 16)
-        time_since_2000_epoch = time - datetime.datetime(2000, 1, 1)
-        packed_time = time_since_2000_epoch + datetime.timedelta(
-            microseconds=time_betw_0_and_2000_ad
-        )
-        return int(packed_time.total_seconds() * 1000 * 1000)
-
     def _recvThreadFunc(self):
         """
         This is the run-function of the recvThread. It receives HCI events from the
         s_snoop socket. The HCI packets are encapsulated in btsnoop records (see RFC 1761).
-        Received HCI packets are being put into the queues inside registeredHciRecvQueues and
-        passed to the callback functions inside registeredHciCallbacks.
+        Received HCI packets are being put into the queues inside registeredHciRecvQueues
+        and the deques inside registeredHciRecvDeques and passed to the callback functions
+        inside registeredHciCallbacks.
         The thread stops when exit_requested is set to True. It will do that on its own
         if it encounters a fatal error or the stackDumpReceiver reports that the chip crashed.
         """
 
         self.logger.debug("Receive Thread started.")
 
+        # Bind frequently used attributes to locals for the per-packet loop. The
+        # registration lists are only modified in place, so the locals stay valid.
+        recv_into = self.s_snoop.recv_into
+        recv_buf = self._recv_buf
+        recv_mv = self._recv_mv
+        recv_queues = self.registeredHciRecvQueues
+        recv_deques = self.registeredHciRecvDeques
+        callbacks = self.registeredHciCallbacks
+        write_btsnooplog = self.write_btsnooplog
+        parse_hci_packet = hci.parse_hci_packet
+
         while not self.exit_requested:
             # Read the record data
             try:
-                record_data = self.s_snoop.recv(1024)
-                record_data = bytearray(record_data)
+                n = recv_into(recv_buf, _H4_MAX_PACKET_SIZE)
             except socket.timeout:
                 continue  # this is ok. just try again without error
             except Exception as e:
@@ -277,48 +402,31 @@ class HCICore(InternalBlue):
                 self.exit_requested = True
                 continue
 
-            # btsnoop record header data:
-            btsnoop_orig_len = len(record_data)
-            btsnoop_inc_len = len(record_data)
-            btsnoop_flags = 0
-            btsnoop_drops = 0
-            btsnoop_time = datetime.datetime.now()
-
-            if btsnoop_orig_len == 0:
+            if n == 0:
                 continue
 
-            # Put all relevant infos into a tuple. The HCI packet is parsed with the help of hci.py.
-            record = (
-                hci.parse_hci_packet(record_data),
-                btsnoop_orig_len,
-                btsnoop_inc_len,
-                btsnoop_flags,
-                btsnoop_drops,
-                btsnoop_time,
-            )
+            # The parsed packet keeps references to its data, so it gets its own
+            # copy while the btsnoop log is written straight from the receive buffer.
+            record_data = recv_buf[:n]
 
-            self.logger.debug(
-                "_recvThreadFunc Recv: [" + str(btsnoop_time) + "] " + str(record[0])
-            )
+            # Write to btsnoop file. The record timestamp is only taken if the
+            # btsnoop log is enabled, otherwise it is None.
+            if write_btsnooplog:
+                timestamp = time.time()
+                self._writeBTSnoopRecord(recv_mv[:n], timestamp)
+                btsnoop_time = datetime.datetime.fromtimestamp(timestamp)
+            else:
+                btsnoop_time = None
 
-            # Write to btsnoop file:
-            if self.write_btsnooplog:
-                btsnoop_record_hdr = struct.pack(
-                    ">IIIIq",
-                    btsnoop_orig_len,
-                    btsnoop_inc_len,
-                    btsnoop_flags,
-                    btsnoop_drops,
-                    self._btsnoop_pack_time(btsnoop_time),
-                )
-                with self.btsnooplog_file_lock:
-                    self.btsnooplog_file.write(btsnoop_record_hdr)
-                    self.btsnooplog_file.write(record_data)
-                    self.btsnooplog_file.flush()
+            # Put all relevant infos into a tuple. The HCI packet is parsed with the help of hci.py.
+            # btsnoop record header data: orig_len, inc_len, flags, drops, time
+            record = (parse_hci_packet(record_data), n, n, 0, 0, btsnoop_time)
+
+            self.logger.debug("_recvThreadFunc Recv: [%s] %s", btsnoop_time, record[0])
 
             # Put the record into all queues of registeredHciRecvQueues if their
             # filter function matches.
-            for queue, filter_function in self.registeredHciRecvQueues:
+            for queue, filter_function in recv_queues:
                 if filter_function is None or filter_function(record):
                     try:
                         queue.put(record, block=False)
@@ -327,9 +435,16 @@ class HCICore(InternalBlue):
                             "recvThreadFunc: A recv queue is full. dropping packets.."
                         )
 
+            # Append the record to all deques of registeredHciRecvDeques if their
+            # filter function matches and wake up the consumer.
+            for recv_deque, event, filter_function in recv_deques:
+                if filter_function is None or filter_function(record):
+                    recv_deque.append(record)
+                    event.set()
+
             # Call all callback functions inside registeredHciCallbacks and pass the
             # record as argument.
-            for callback in self.registeredHciCallbacks:
+            for callback in callbacks:
                 callback(record)
 
             # Check if the stackDumpReceiver has noticed that the chip crashed.
@@ -352,6 +467,28 @@ class HCICore(InternalBlue):
                 self.btsnooplog_file.flush()
 
 
+    def _writeBTSnoopRecord(self, data, timestamp=None):
+        # type: (bytes, Optional[float]) -> None
+        """
+        Append a btsnoop record containing the H4 packet data to the btsnoop file.
+        timestamp is the unix time of the packet, the current time if it is None.
+        Header and data are appended with an unbuffered write to the file descriptor,
+        a short write (e.g. if the disk is full) is continued with the remaining bytes.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        btsnoop_record = _packBTSnoopRecordHeader(len(data), timestamp) + data
+        written = os.write(self._btsnoop_fd, btsnoop_record)
+        if written < len(btsnoop_record):
+            remaining = memoryview(btsnoop_record)[written:]
+            while remaining:
+                written = os.write(self._btsnoop_fd, remaining)
+                if written == 0:
+                    raise IOError(
+                        "Could not write btsnoop record to %s" % self.btsnooplog_file.name
+                    )
+                remaining = remaining[written:]
+
     def _setupSockets(self):
         """
         Linux already allows to open HCI sockets to Bluetooth devices,
@@ -411,48 +548,62 @@ class HCICore(InternalBlue):
 
     def _setupSocketsUserChannel(self):
         """
-            Python's socket API does not allow to set up an HCI User Channel
-            so we need to use ctypes here. Most parts of this are taken from
-            scapy's code (https://github.com/secdev/scapy/blob/master/scapy/layers/bluetooth.py#L1482)
+            Only recent versions of Python's socket API allow to bind an HCI socket
+            to the User Channel, so we fall back to ctypes otherwise. Most parts of
+            the ctypes code are taken from scapy's code
+            (https://github.com/secdev/scapy/blob/master/scapy/layers/bluetooth.py#L1482)
         """
 
-        sockaddr_hcip = POINTER(sockaddr_hci)
-        cdll.LoadLibrary("libc.so.6")
-        libc = CDLL("libc.so.6")
+        dev_id = 0  # adapter index
+
+        s = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW, socket.BTPROTO_HCI)
+        try:
+            s.bind((dev_id, HCI_CHANNEL_USER))
+            self.s_snoop = s
+        except (OSError, TypeError) as e:
+            # (dev_id, channel) address not supported, or binding failed. Retry via
+            # ctypes, which also reports the error if binding is not possible.
+            self.logger.debug(
+                "Binding the HCI User Channel with socket.bind() failed (%s), retrying via ctypes"
+                % str(e)
+            )
+            s.close()
+            self.s_snoop = self._bindUserChannelCtypes(dev_id)
+
+        # same socket for input and output (this is different from adb here!)
+        self.s_inject = self.s_snoop
 
-        socket_c = libc.socket
-        socket_c.argtypes = (c_int, c_int, c_int);
-        socket_c.restype = c_int
+        self._writeBTSnoopHeader()
+
+        return True
 
-        bind = libc.bind
-        bind.argtypes = (c_int, POINTER(sockaddr_hci), c_int)
-        bind.restype = c_int
+    def _bindUserChannelCtypes(self, dev_id):
+        # type: (int) -> socket.socket
+        """
+        Open an HCI socket and bind it to the User Channel of the adapter with
+        index dev_id using libc's socket() and bind().
+        """
 
-        s = socket_c(31, 3, 1) # (AF_BLUETOOTH, SOCK_RAW, HCI_CHANNEL_USER)
+        libc = _getLibc()
+
+        s = libc.socket(31, 3, 1)  # (AF_BLUETOOTH, SOCK_RAW, BTPROTO_HCI)
         if s < 0:
             self.logger.error("Unable to open PF_BLUETOOTH socket")
 
         sa = sockaddr_hci()
         sa.sin_family = 31  # AF_BLUETOOTH
-        sa.hci_dev = 0      # adapter index
-        sa.hci_channel = 1  # HCI_USER_CHANNEL
+        sa.hci_dev = dev_id
+        sa.hci_channel = HCI_CHANNEL_USER
 
-        r = bind(s, sockaddr_hcip(sa), sizeof(sa))
+        r = libc.bind(s, pointer(sa), sizeof(sa))
         if r != 0:
             self.logger.error("Unable to bind")
 
-        self.s_snoop = socket.fromfd(s, 31, 3, 1)
-
-        # same socket for input and output (this is different from adb here!)
-        self.s_inject = self.s_snoop
-
-        self._writeBTSnoopHeader()
-
-        return True
+        return socket.fromfd(s, 31, 3, 1)
 
     def _teardownSockets(self):
         """
-        Close s_snoop and s_inject socket. (equal)
+        Close s_snoop and s_inject socket (equal) and the ioctl socket.
         """
 
         if self.s_inject is not None:
@@ -460,4 +611,8 @@ class HCICore(InternalBlue):
             self.s_inject = None
             self.s_snoop = None
 
+        if self._ioctl_sock is not None:
+            self._ioctl_sock.close()
+            self._ioctl_sock = None
+
         return True
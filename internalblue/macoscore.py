@@ -6,6 +6,7 @@ import os
 import queue as queue2k
 import random
 import socket
+import struct
 import time
 from builtins import str
 
@@ -13,13 +14,15 @@ from future import standard_library
 
 from . import hci
 from .core import InternalBlue
-from .utils.packing import p8
 
 standard_library.install_aliases()
 filepath = os.path.dirname(os.path.abspath(__file__))
 
 IOBE = None
 
+# HCI command opcode, little endian on the wire
+_OPCODE_LE = struct.Struct("<H")
+
 
 # noinspection SpellCheckingInspection
 class macOSCore(InternalBlue):
@@ -53,6 +56,8 @@ class macOSCore(InternalBlue):
                 globals=globals(),
             )
         self.hciport = -1
+        # Persistent receive buffer for s_snoop, filled with recv_into()
+        self._recv_buf = bytearray(1024)
 
     def device_list(self):
         """
@@ -116,13 +121,16 @@ class macOSCore(InternalBlue):
 
         self.logger.debug("Receive Thread started.")
 
+        recv_into = self.s_snoop.recv_into
+        recv_buf = self._recv_buf
+
         while not self.exit_requested:
-            # read record data
+            # read record data, one HCI packet per datagram
             try:
-                data, addr = self.s_snoop.recvfrom(1024)
-                record_data = bytearray(data)
+                n = recv_into(recv_buf, 1024)
             except socket.timeout:
                 continue  # this is ok. just try again without error
+            record_data = recv_buf[:n]
 
             if not self.exit_requested:
                 # Put all relevant infos into a tuple. The HCI packet is parsed with the help of hci.py.
@@ -171,9 +179,6 @@ class macOSCore(InternalBlue):
             # Extract the components of the task
             h4type, data, queue, filter_function = task
 
-            # Prepend UART TYPE and length.
-            out = p8(h4type) + p8(len(data)) + data
-
             # Check if command is not a H4 type
             if not (h4type == 0x01 or h4type == 0x02):
                 self.logger.warn(f"H4 Type {str(h4type)} not supported by macOS Core!")
@@ -188,16 +193,13 @@ class macOSCore(InternalBlue):
                     queue.put(None)
                 continue
 
+            # Prepend UART TYPE and length.
+            out = bytes((h4type, len(data))) + data
+
             # Send command to the chip using IOBluetoothExtended framework
-            data = bytearray(data)
-            opcode = format(data[1], "02x") + format(data[0], "02x")
-
-            self.logger.debug(
-                "Sending command: 0x"
-                + "".join(format(x, "02x") for x in data)
-                + ", opcode: "
-                + opcode
-            )
+            opcode = _OPCODE_LE.unpack_from(data, 0)[0]
+
+            self.logger.debug("Sending command: 0x%s, opcode: %04x", data.hex(), opcode)
 
             # if the caller expects a response: register a queue to receive the response
             if queue is not None and filter_function is not None:
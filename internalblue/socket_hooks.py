@@ -30,6 +30,18 @@ class SocketRecvHook(object):
         self.recv_hook(data)
         return data
 
+    def recv_into(self, buffer, nbytes=0, **kwargs):
+        nbytes = nbytes or len(buffer)
+        if not self.replace:
+            n = self.snoop_socket.recv_into(buffer, nbytes, **kwargs)
+            data = bytes(buffer[:n])
+        else:
+            data = self.recv_replace(nbytes, **kwargs)[:nbytes]
+            n = len(data)
+            buffer[:n] = data
+        self.recv_hook(data)
+        return n
+
     def recvfrom_replace(self, length, **kwargs):
         raise NotImplementedError("recvfrom_replace not implemented")
 
@@ -1,52 +1,40 @@
 import struct
 
 
+# Precompiled struct formats, indexed by the endian argument of the helpers below.
+# '' keeps the native byte order of the plain struct format. The u* helpers accept
+# any bytes-like object of the exact size (bytes, bytearray, memoryview).
+_B = {'': struct.Struct('B'), 'little': struct.Struct('<B'), 'big': struct.Struct('>B')}
+_H = {'': struct.Struct('H'), 'little': struct.Struct('<H'), 'big': struct.Struct('>H')}
+_I = {'': struct.Struct('I'), 'little': struct.Struct('<I'), 'big': struct.Struct('>I')}
+
+
+def _struct(formats, endian: str) -> struct.Struct:
+    return formats.get(endian.lower(), formats[''])
+
+
 def p8(num, endian: str = ''):
-    if endian.lower() == 'big':
-        return struct.pack('>B', num)
-    elif endian.lower() == 'little':
-        return struct.pack('<B', num)
-    return struct.pack('B', num)
+    return _struct(_B, endian).pack(num)
 
 
 def u8(num, endian: str = ''):
-    if endian.lower() == 'big':
-        return struct.unpack('>B', num)[0]
-    elif endian.lower() == 'little':
-        return struct.unpack('<B', num)[0]
-    return struct.unpack('B', num)[0]
+    return _struct(_B, endian).unpack(num)[0]
 
 
 def p16(num, endian: str = ''):
-    if endian.lower() == 'big':
-        return struct.pack('>H', num)
-    elif endian.lower() == 'little':
-        return struct.pack('<H', num)
-    return struct.pack('H', num)
+    return _struct(_H, endian).pack(num)
 
 
 def u16(num, endian: str = ''):
-    if endian.lower() == 'big':
-        return struct.unpack('>H', num)[0]
-    elif endian.lower() == 'little':
-        return struct.unpack('<H', num)[0]
-    return struct.unpack('H', num)[0]
+    return _struct(_H, endian).unpack(num)[0]
 
 
 def p32(num, endian: str = ''):
-    if endian.lower() == 'big':
-        return struct.pack('>I', num)
-    elif endian.lower() == 'little':
-        return struct.pack('<I', num)
-    return struct.pack('I', num)
+    return _struct(_I, endian).pack(num)
 
 
 def u32(num, endian: str = ''):
-    if endian.lower() == 'big':
-        return struct.unpack('>I', num)[0]
-    elif endian.lower() == 'little':
-        return struct.unpack('<I', num)[0]
-    return struct.unpack('I', num)[0]
+    return _struct(_I, endian).unpack(num)[0]
 
 
 def bits(s, endian='big') -> [int]:
@@ -0,0 +1,82 @@
+from internalblue.hcicore import HCICore, _decodeHciFlags, _packBTSnoopRecordHeader
+
+import os
+import socket
+import struct
+import threading
+
+
+def test_btsnoop_record_header():
+    # 2000-01-01 00:00:00.5 UTC, btsnoop time is microseconds since 0 AD
+    hdr = _packBTSnoopRecordHeader(7, 946684800.5)
+
+    assert len(hdr) == 24
+    assert hdr == struct.pack(">IIIIq", 7, 7, 0, 0, 0x00E03AB44A676000 + 500000)
+    assert hdr[16:] == bytes.fromhex("00e03ab44a6f0120")
+
+
+def _feed_records(core, packets):
+    # Run the receive thread on one end of a socket pair and send the H4 packets
+    # from the other end, one packet per datagram like an HCI socket.
+    snoop, peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    snoop.settimeout(0.1)
+    core.s_snoop = snoop
+    recv_thread = threading.Thread(target=core._recvThreadFunc)
+    recv_thread.start()
+    done, done_event = core.registerHciRecvDeque(maxlen=len(packets))
+    for packet in packets:
+        peer.send(packet)
+    while len(done) < len(packets):
+        done_event.wait(timeout=2)
+        done_event.clear()
+    core.exit_requested = True
+    recv_thread.join()
+    snoop.close()
+    peer.close()
+
+
+def test_recv_deque_filter_and_maxlen():
+    core = HCICore(btsnooplog_filename=None)
+    command_complete = [
+        bytes.fromhex("040e0401%02x1000" % i) for i in range(1, 4)
+    ]  # Command Complete Events for opcodes 0x1001..0x1003
+    command_status = bytes.fromhex("040f0400010110")
+
+    recv_deque, event = core.registerHciRecvDeque(
+        lambda record: record[0].event_code == 0x0E, maxlen=2
+    )
+    _feed_records(core, [command_complete[0], command_status] + command_complete[1:])
+
+    assert event.is_set()
+    # Only the command complete events pass the filter, the oldest one was dropped
+    assert [bytes(record[0].data) for record in recv_deque] == [
+        packet[3:] for packet in command_complete[1:]
+    ]
+
+    core.unregisterHciRecvDeque(recv_deque)
+    assert all(entry[0] is not recv_deque for entry in core.registeredHciRecvDeques)
+
+
+def test_btsnoop_record_short_write(monkeypatch, tmp_path):
+    core = HCICore(btsnooplog_filename="btsnoop.log", data_directory=str(tmp_path))
+    data = bytes.fromhex("01031000")
+
+    # Let every write() only write up to 5 bytes
+    os_write = os.write
+    monkeypatch.setattr(os, "write", lambda fd, buf: os_write(fd, bytes(buf[:5])))
+    core._writeBTSnoopRecord(data, 946684800.5)
+    monkeypatch.undo()
+    core.btsnooplog_file.close()
+
+    with open(str(tmp_path / "btsnoop.log"), "rb") as f:
+        log = f.read()
+    assert log.endswith(_packBTSnoopRecordHeader(len(data), 946684800.5) + data)
+
+
+def test_decode_hci_flags():
+    assert _decodeHciFlags(0) == "DOWN"
+    assert _decodeHciFlags(0b101) == "UP RUNNING"
+    assert _decodeHciFlags((1 << 0) | (1 << 3) | (1 << 4) | (1 << 9)) == "UP PSCAN ISCAN RESET"
+    # Bits without a name are ignored
+    assert _decodeHciFlags(1 << 12) == "DOWN"
+    assert _decodeHciFlags((1 << 12) | 1) == "UP"
@@ -0,0 +1,38 @@
+from internalblue.utils.packing import p8, u8, p16, u16, p32, u32
+
+import struct
+import sys
+
+import pytest
+
+
+def test_pack_unpack_endian():
+    native = "<" if sys.byteorder == "little" else ">"
+    for endian, order in (("", native), ("little", "<"), ("big", ">")):
+        assert p8(0xAB, endian) == b"\xab"
+        assert u8(b"\xab", endian) == 0xAB
+
+        assert p16(0x1234, endian) == struct.pack(order + "H", 0x1234)
+        assert u16(struct.pack(order + "H", 0x1234), endian) == 0x1234
+
+        assert p32(0x12345678, endian) == struct.pack(order + "I", 0x12345678)
+        assert u32(struct.pack(order + "I", 0x12345678), endian) == 0x12345678
+
+    assert p16(0x1234, "big") == b"\x12\x34"
+    assert p32(0x12345678, "little") == b"\x78\x56\x34\x12"
+    # Upper case endian names are accepted as well
+    assert u32(b"\x12\x34\x56\x78", "BIG") == 0x12345678
+
+
+def test_unpack_bytes_like():
+    assert u16(bytearray(b"\x34\x12"), "little") == 0x1234
+    assert u32(memoryview(b"\x00\x01\x02\x03\x04")[1:], "big") == 0x01020304
+
+
+def test_unpack_exact_size():
+    with pytest.raises(struct.error):
+        u8(b"\x01\x02")
+    with pytest.raises(struct.error):
+        u16(b"\x01", "little")
+    with pytest.raises(struct.error):
+        u32(b"\x01\x02\x03\x04\x05", "big")
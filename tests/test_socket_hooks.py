@@ -0,0 +1,44 @@
+from internalblue.socket_hooks import ReplaySocket, TraceToFileHook
+
+import os
+import socket
+import tempfile
+
+
+def test_replay_socket_recv_into():
+    packet = bytes.fromhex("040e0401011000")
+    with tempfile.TemporaryDirectory() as directory:
+        trace = os.path.join(directory, "recv_into.trace")
+        with open(trace, "w") as f:
+            f.write("RX {}\n".format(packet.hex()))
+
+        replay_socket = ReplaySocket(None, None, None, filename=trace)
+        buf = bytearray(1024)
+        n = replay_socket.recv_into(buf, 1024)
+
+    assert n == len(packet)
+    assert buf[:n] == packet
+
+
+def test_trace_hook_recv_into_udp():
+    # macOSCore receives the HCI packets from IOBluetoothExtended as UDP datagrams
+    packet = bytes.fromhex("040e0401011000")
+    snoop = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    snoop.bind(("127.0.0.1", 0))
+    snoop.settimeout(2)
+    inject = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    with tempfile.TemporaryDirectory() as directory:
+        trace = os.path.join(directory, "recv_into.trace")
+        trace_hook = TraceToFileHook(snoop, inject, None, filename=trace)
+
+        inject.sendto(packet, snoop.getsockname())
+        buf = bytearray(1024)
+        n = trace_hook.recv_into(buf, 1024)
+        trace_hook.close()
+
+        with open(trace) as f:
+            log = f.readlines()
+
+    assert n == len(packet)
+    assert buf[:n] == packet
+    assert log[0] == "RX {}\n".format(packet.hex())